@@ -35,23 +35,36 @@ The criteria to identify that the system is idle is configurable:
 VERSION:
 """
 
-import argparse
-import datetime
-import json
+import atexit
+import getopt
 import logging
-import multiprocessing
+import os
 import pwd
 import re
+import select
 import shlex
 import signal
+import socket
 import subprocess
 import sys
 import threading
 import time
+import types
 import typing
 
 Logger = logging.getLogger()
 
+COMMAND_TIMEOUT = 5  # maximum duration of external commands, in seconds
+# maximum duration of the login of a UserCommand helper, in seconds
+# helpers may be started from the main loop: login and command shall fit well within the watchdog period
+HELPER_STARTUP_TIMEOUT = 20
+
+_DURATION_RE = re.compile(
+    r"(?:(\d+)[yY])?(?:(\d+)M)?(?:(\d+)[wW])?(?:(\d+)[dD])?(?:(\d+)[hH])?(?:(\d+)m)?(?:(\d+)[sS])?"
+)
+_DURATION_PLAIN_RE = re.compile(r"\d+(?:\.\d*)?")
+_TIME_RE = re.compile(r"(\d{1,2}):(\d{2})(?::(\d{2}))?")
+
 
 def parse_duration(duration_str: str) -> int:
     """Parse string giving a duration.
@@ -69,72 +82,443 @@ def parse_duration(duration_str: str) -> int:
     Returns:
         number of seconds
     """
-    match = re.fullmatch(
-        r"(?:(\d+)[yY])?(?:(\d+)M)?(?:(\d+)[wW])?(?:(\d+)[dD])?(?:(\d+)[hH])?(?:(\d+)m)?(?:(\d+)[sS])?",
-        duration_str,
-    )
+    match = _DURATION_RE.fullmatch(duration_str)
     if not match:
         # no unit, shall contain a single integer or float value
-        if not re.fullmatch(r"\d+(?:\.\d*)?", duration_str):
+        if not _DURATION_PLAIN_RE.fullmatch(duration_str):
             raise ValueError(f"invalid duration string '{duration_str}'")
         return float(duration_str)
-    years, months, weeks, days, hours, minutes, seconds = map(lambda x: 0 if x is None else int(x), match.groups())
-    days += 365 * years + 30 * months + 7 * weeks
-    hours += 24 * days
-    minutes += 60 * hours
-    seconds += 60 * minutes
-    return seconds
+    years, months, weeks, days, hours, minutes, seconds = map(int, match.groups(default="0"))
+    return seconds + 60 * (minutes + 60 * (hours + 24 * (days + 7 * weeks + 30 * months + 365 * years)))
 
 
-def parse_time(time_str: str) -> datetime.time:
+def parse_time(time_str: str) -> typing.Tuple[int, int, int]:
     """Parse string giving a time of the day.
 
     Expected input: HH:MM[:SS], in 24-hour format
+
+    Returns:
+        hour, minute, second
     """
-    match = re.fullmatch(
-        r"(\d{1,2}):(\d{2})(?::(\d{2}))?",
-        time_str,
-    )
+    match = _TIME_RE.fullmatch(time_str)
     if not match:
         raise ValueError(f"invalid time string '{time_str}', wrong format")
-    hour, minute, second = map(lambda x: 0 if x is None else int(x), match.groups())
+    hour, minute, second = map(int, match.groups(default="0"))
     if hour >= 24 or minute >= 60 or second >= 60:
         raise ValueError(f"invalid time string '{time_str}', out of range value")
-    return datetime.time(hour, minute, second)
+    return hour, minute, second
+
+
+SLEEP_STATES = ["suspend", "hibernate", "hybrid-sleep"]
+
+
+def parse_state(state_str: str) -> str:
+    """Parse string giving a sleep state."""
+    if state_str not in SLEEP_STATES:
+        raise ValueError(f"invalid choice: '{state_str}' (choose from {', '.join(SLEEP_STATES)})")
+    return state_str
+
+
+# command line options: short option, long option, metavar (None for flags), conversion, default value, help
+OPTIONS = [
+    ("d", "debug", None, None, False, "get debug log"),
+    ("P", "pretend", None, None, False, "log instead of requesting sleep"),
+    ("t", "time", "TIME", parse_duration, "10m", "minimum idle time to transition to sleep"),
+    ("s", "state", "{" + ",".join(SLEEP_STATES) + "}", parse_state, "suspend", "wanted sleep state"),
+    ("w", "wake-up", "HH:MM[:SS]", parse_time, None, "local time for wake-up (in the next 24 hours)"),
+    ("u", "user", "USER", str, None, "user name to be used for X or audio check"),
+    ("x", "x-input", None, None, False, "check lack of X inputs from the user, via `xprintidle`"),
+    ("a", "audio", None, None, False, "check lack of audio output, via `pulseaudio`"),
+    (
+        "p",
+        "meas-period",
+        "MEAS_PERIOD",
+        parse_duration,
+        "10s",
+        "measurement period, for CPU / network usage; doubled at each idle period, up to 1/4 of TIME",
+    ),
+    ("c", "cpu", "MAX_USAGE%", int, None, "maximum CPU usage allowed to consider idle, in %"),
+    (
+        "n",
+        "network",
+        "PACKETS",
+        int,
+        None,
+        "maximum number of Rx / Tx packets per MEAS_PERIOD to consider idle (scaled when the measurement period grows)",
+    ),
+    (
+        "C",
+        "connection",
+        "SS_ARGS",
+        str,
+        None,
+        "check active network connections using 'ss -HOn ${SS_ARGS}'; no connection shall be returned to consider the machine idle\nExample to detect incoming or outgoing SSH connections over IPv6: \"-6 -t state established 'sport 22 or dport 22'\"",
+    ),
+]
+
+
+def usage() -> str:
+    """Get usage line of the command line"""
+    prefix = f"usage: {os.path.basename(sys.argv[0])}"
+    options = ["[-h]"] + [f"[-{short} {metavar}]" if metavar else f"[-{short}]" for short, _, metavar, *_ in OPTIONS]
+    lines = [prefix]
+    for option in options:
+        if len(lines[-1]) + 1 + len(option) > 80 and lines[-1] != prefix:
+            lines.append(" " * len(prefix))
+        lines[-1] += " " + option
+    return "\n".join(lines)
+
+
+def usage_error(message: str) -> typing.NoReturn:
+    """Report an error in the command line, and exit"""
+    print(usage(), file=sys.stderr)
+    print(f"{os.path.basename(sys.argv[0])}: error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def print_help():
+    """Print help of the command line"""
+    print(usage())
+    print()
+    print(__doc__)
+    print("options:")
+    lines = [("-h, --help", "show this help message and exit")]
+    for short, long, metavar, _, _, help_str in OPTIONS:
+        lines.append((f"-{short} {metavar}, --{long} {metavar}" if metavar else f"-{short}, --{long}", help_str))
+    for flags, help_str in lines:
+        help_lines = help_str.split("\n")
+        if len(flags) <= 20:
+            print(f"  {flags:<22}{help_lines[0]}")
+        else:
+            print(f"  {flags}")
+            print(f"{'':<24}{help_lines[0]}")
+        for help_line in help_lines[1:]:
+            print(f"{'':<24}{help_line}")
+
 
+def parse_args(argv: typing.List[str]) -> types.SimpleNamespace:
+    """Parse command line arguments
 
-def datetime_now() -> datetime.datetime:
-    """Get current datetime in local aware timezone."""
-    now = datetime.datetime.now(datetime.timezone.utc)
-    return now.astimezone()
+    Args:
+        argv: command line arguments, without the program name
+
+    Returns:
+        parsed arguments, one attribute per long option
+    """
+    args = types.SimpleNamespace()
+    options = {}  # option as reported by getopt => destination attribute, conversion
+    for short, long, metavar, conversion, default, _ in OPTIONS:
+        dest = long.replace("-", "_")
+        # as for argparse, string default values go through the conversion
+        setattr(args, dest, conversion(default) if isinstance(default, str) else default)
+        options[f"-{short}"] = options[f"--{long}"] = (dest, conversion if metavar else None)
+
+    try:
+        opts, positional = getopt.gnu_getopt(
+            argv,
+            "h" + "".join(short + (":" if metavar else "") for short, _, metavar, *_ in OPTIONS),
+            ["help"] + [long + ("=" if metavar else "") for _, long, metavar, *_ in OPTIONS],
+        )
+    except getopt.GetoptError as exc:
+        usage_error(str(exc))
+    if positional:
+        usage_error(f"unrecognized arguments: {' '.join(positional)}")
+
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit(0)
+        dest, conversion = options[opt]
+        if conversion is None:
+            setattr(args, dest, True)
+        else:
+            try:
+                setattr(args, dest, conversion(value))
+            except ValueError as exc:
+                usage_error(f"argument {opt}: {exc}")
+    return args
 
 
-def get_cpu_idle() -> float:
-    """Get cumulated system idle time"""
-    with open("/proc/uptime", "rt") as uptime_file:
-        return float(uptime_file.readline().split()[1])
+def monotonic_ns() -> int:
+    """Get monotonic time in ns, including the time spent in sleep states"""
+    # CLOCK_MONOTONIC does not advance during suspend, which would hide the sleep cycles
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+
+def read_proc_file(proc_fd: int) -> bytes:
+    """Read the whole content of a procfs file kept open
+
+    Content is generated again by the kernel when reading from the beginning of the file.
+    """
+    content = b""
+    while True:
+        chunk = os.pread(proc_fd, 4096, len(content))
+        if not chunk:
+            return content
+        content += chunk
+
+
+def get_cpu_times(stat_fd: int) -> typing.Tuple[int, int]:
+    """Get cumulated idle and total CPU times of all CPUs, from /proc/stat
+
+    Returns:
+        idle time, total time (in USER_HZ)
+    """
+    # first line: cpu user nice system idle iowait irq softirq steal guest guest_nice
+    # guest times are already accounted in user times
+    cpu_times = [int(field) for field in os.pread(stat_fd, 256, 0).split(b"\n", 1)[0].split()[1:9]]
+    return cpu_times[3] + cpu_times[4], sum(cpu_times)
+
+
+def is_interface_up(ifname: str) -> bool:
+    """Check whether the operational state of a network interface is up"""
+    try:
+        operstate_fd = os.open(f"/sys/class/net/{ifname}/operstate", os.O_RDONLY)
+    except OSError:
+        # interface has disappeared
+        return False
+    try:
+        return os.read(operstate_fd, 2) == b"up"
+    finally:
+        os.close(operstate_fd)
+
+
+def get_net_stat(
+    net_dev_fd: int, prev_ifname: typing.Optional[str] = None
+) -> typing.Tuple[typing.Optional[str], int, int]:
+    """Get network statistics
+
+    Args:
+        net_dev_fd: file descriptor of /proc/net/dev
+        prev_ifname: interface used at previous tick, kept as long as it is up
 
+    Returns:
+        statistics of the first UP interface: interface name (None if no UP interface),
+        number of received packets, number of transmitted packets
+    """
+    # /proc/net/dev: 2 header lines, then one line per interface:
+    # ifname: 8 Rx counters (bytes, packets...) then 8 Tx counters (bytes, packets...)
+    interfaces = {}
+    for line in read_proc_file(net_dev_fd).splitlines()[2:]:
+        ifname, counters = line.split(b":", 1)
+        interfaces[ifname.strip().decode()] = counters
+    if prev_ifname not in interfaces or not is_interface_up(prev_ifname):
+        prev_ifname = next((ifname for ifname in interfaces if is_interface_up(ifname)), None)
+    if prev_ifname is None:
+        return None, 0, 0
+    counters = interfaces[prev_ifname].split()
+    return prev_ifname, int(counters[1]), int(counters[9])
+
+
+class UserCommand:
+    """Command run in the session of a user, through a long-lived helper process
+
+    Running a command via runuser forks a login shell and opens a PAM session, which is much more expensive
+    than the command itself. The helper is started once, and runs the command each time a line is written
+    to its stdin; the output of the command is followed by a marker line giving its return code.
+    A first marker line is reported once the helper is started.
+    """
 
-class NetStat(typing.NamedTuple):
-    """Network statistics"""
+    END_MARKER = b"sleep-when-idle-command-returned:"
 
-    ifname: str = "No UP interface"  # interface name
-    rx_packets: int = 0  # number of received packets
-    tx_packets: int = 0  # number of transmitted packets
+    def __init__(self, user: str, env: typing.Dict[str, str], command: str):
+        print_marker = f"printf '\\n{self.END_MARKER.decode()}%d\\n'"
+        self.args = [
+            "runuser",
+            "-l",
+            user,
+            # the helper loop relies on POSIX sh, whatever the login shell of the user
+            "-s",
+            "/bin/sh",
+            "-w",
+            ",".join(env),
+            "-c",
+            f"{print_marker} 0; while IFS= read -r _; do {{ {command}; }} </dev/null; {print_marker} $?; done",
+        ]
+        self.env = env
+        self.process = None
+        atexit.register(self.stop)
+
+    def run(self) -> subprocess.CompletedProcess:
+        """Run the command, starting the helper if needed
+
+        Returns:
+            completed process, with stdout of the command
+        """
+        if self.process is None:
+            self.process = subprocess.Popen(
+                self.args,
+                env=self.env,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            # wait for the helper to be started: login may be much longer than the command itself
+            res = self.read_output(HELPER_STARTUP_TIMEOUT)
+            if res.returncode != 0:
+                return res
+        try:
+            self.process.stdin.write(b"\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass  # helper has terminated, stdout will report EOF
+        return self.read_output(COMMAND_TIMEOUT)
+
+    def read_output(self, timeout: float) -> subprocess.CompletedProcess:
+        """Read the output of the helper, up to the next marker line
+
+        Args:
+            timeout: maximum duration to get the marker line, in seconds
+
+        Returns:
+            completed process, with stdout of the command
+        """
+        stdout_fd = self.process.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        output = b""
+        while True:
+            # output ends with the marker line, preceded by a newline
+            marker_pos = output.rfind(b"\n" + self.END_MARKER)
+            if marker_pos >= 0 and output.endswith(b"\n"):
+                returncode = int(output[marker_pos + 1 + len(self.END_MARKER) :])
+                return subprocess.CompletedProcess(self.args, returncode, output[:marker_pos])
+
+            readable, _, _ = select.select([stdout_fd], [], [], max(deadline - time.monotonic(), 0))
+            if not readable:
+                # helper is stuck: it will be restarted at next run
+                self.stop()
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            chunk = os.read(stdout_fd, 4096)
+            if not chunk:
+                # helper has terminated: it will be restarted at next run
+                returncode = self.stop()
+                return subprocess.CompletedProcess(self.args, returncode or 1, b"")
+            output += chunk
+
+    def stop(self) -> typing.Optional[int]:
+        """Stop the helper, if running
+
+        Returns:
+            return code of the helper
+        """
+        if self.process is None:
+            return None
+        process, self.process = self.process, None
+        try:
+            # closing stdin terminates the loop of the helper
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            return process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+        # runuser forwards SIGTERM to the shell, then kills it if needed, and closes the PAM session
+        process.terminate()
+        try:
+            return process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            return process.wait()
+
+
+class AudioMonitor(threading.Thread):
+    """Monitor audio output of the user pulseaudio daemon
+
+    Instead of polling the daemon at each tick, follow the events reported by `pactl subscribe`,
+    and query the state of the sinks only when they change.
+    """
 
+    def __init__(self, user: str, uid: int, exit_event: threading.Event):
+        super().__init__(name="AudioMonitor", daemon=True)
+        # root has no direct access to the pulseaudio daemon
+        # To follow the events of the user pulseaudio daemon, use the following command:
+        # XDG_RUNTIME_DIR=/run/user/uid runuser -l user -w XDG_RUNTIME_DIR -c "pactl subscribe"
+        self.env = {"XDG_RUNTIME_DIR": f"/run/user/{uid}"}
+        self.subscribe_args = ["runuser", "-l", user, "-w", "XDG_RUNTIME_DIR", "-c", "pactl subscribe"]
+        # a sink is in RUNNING state when at least one of its inputs is playing
+        self.sinks_command = UserCommand(user, self.env, "pactl list short sinks")
+        self.exit_event = exit_event
+        self.process = None
+        self.running = False  # audio output is active
+        self.last_running_ns = None  # last time audio output was active, see monotonic_ns()
+        atexit.register(self.stop)
 
-def get_net_stat() -> NetStat:
-    """Get network statistics"""
-    res = subprocess.run(["ip", "-j", "-s", "link"], capture_output=True, check=True, text=True)
-    parsed_output = json.loads(res.stdout)
-    for interface in parsed_output:
-        if interface["operstate"] == "UP":
-            return NetStat(
-                interface["ifname"],
-                interface["stats64"]["rx"]["packets"],
-                interface["stats64"]["tx"]["packets"],
+    def run(self):
+        """Thread main loop, follow pulseaudio events"""
+        while not self.exit_event.is_set():
+            self.process = subprocess.Popen(
+                self.subscribe_args,
+                env=self.env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
             )
-    return NetStat()
+            self.update()
+            for line in self.process.stdout:
+                # "Event 'change' on sink #0", "Event 'new' on sink-input #42"...
+                if b" on sink" in line:
+                    self.update()
+            self.process.wait()
+            # pulseaudio is not started yet or has been stopped => consider there is no audio, retry later
+            self.set_running(False)
+            self.exit_event.wait(10)
+
+    def update(self):
+        """Update audio state from the state of the sinks"""
+        try:
+            res = self.sinks_command.run()
+        except subprocess.TimeoutExpired:
+            Logger.warning("Timeout when getting the state of the sinks; keeping audio state")
+            return
+        self.set_running(res.returncode == 0 and b"\tRUNNING" in res.stdout)
+
+    def set_running(self, running: bool):
+        """Set audio state, recording when audio output stops"""
+        if running != self.running:
+            Logger.debug("audio is %s", "running" if running else "stopped")
+            if not running:
+                # set before clearing the flag: the main thread reads the flag first
+                self.last_running_ns = monotonic_ns()
+            self.running = running
+
+    def stop(self):
+        """Stop following pulseaudio events"""
+        if self.process is not None:
+            self.process.terminate()
+
+
+class SystemdNotifier:
+    """Notify systemd of the state of the service, see sd_notify(3)
+
+    Notifications are skipped when the daemon is not run as a notify service.
+    As for sd_notify(3), they are best effort: failures are logged and ignored.
+    """
+
+    def __init__(self):
+        self.socket = None
+        self.address = None  # notify socket address
+        self.watchdog_period_ns = None  # maximum period between two watchdog notifications, if enabled
+        address = os.environ.get("NOTIFY_SOCKET")
+        if not address:
+            return
+        if address[0] == "@":
+            # abstract namespace socket
+            address = "\0" + address[1:]
+        self.address = address
+        # not connected: the address is given at each notification, the notify socket may be re-created
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        if watchdog_usec and os.environ.get("WATCHDOG_PID", str(os.getpid())) == str(os.getpid()):
+            # notify twice per watchdog timeout, as recommended
+            self.watchdog_period_ns = int(watchdog_usec) * 1000 // 2
+
+    def notify(self, state: bytes):
+        """Send a notification, like READY=1 or WATCHDOG=1"""
+        if self.socket is not None:
+            try:
+                self.socket.sendto(state, self.address)
+            except OSError as exc:
+                Logger.debug("Failed to notify systemd of %s: %s", state, exc)
 
 
 class SleepWhenIdle:
@@ -145,97 +529,25 @@ class SleepWhenIdle:
         # configure signals
         for sig in signal.SIGINT, signal.SIGTERM:
             signal.signal(sig, self._signal_handler)
-
-        # build parser
-        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-        parser.add_argument(
-            "-d",
-            "--debug",
-            action="store_true",
-            help="get debug log",
-        )
-        parser.add_argument(
-            "-P",
-            "--pretend",
-            action="store_true",
-            help="log instead of requesting sleep",
-        )
-        parser.add_argument(
-            "-t",
-            "--time",
-            type=parse_duration,
-            default="10m",
-            help="minimum idle time to transition to sleep",
-        )
-        parser.add_argument(
-            "-s",
-            "--state",
-            default="suspend",
-            choices=["suspend", "hibernate", "hybrid-sleep"],
-            help="wanted sleep state",
-        )
-        parser.add_argument(
-            "-w",
-            "--wake-up",
-            metavar="HH:MM[:SS]",
-            type=parse_time,
-            help="local time for wake-up (in the next 24 hours)",
-        )
-        parser.add_argument(
-            "-u",
-            "--user",
-            metavar="USER",
-            help="user name to be used for X or audio check",
-        )
-        parser.add_argument(
-            "-x",
-            "--x-input",
-            action="store_true",
-            help="check lack of X inputs from the user, via `xprintidle`",
-        )
-        parser.add_argument(
-            "-a",
-            "--audio",
-            action="store_true",
-            help="check lack of audio output, via `pulseaudio`",
-        )
-        parser.add_argument(
-            "-p",
-            "--meas-period",
-            type=parse_duration,
-            default="10s",
-            help="measurement period, for CPU / network usage",
-        )
-        parser.add_argument(
-            "-c",
-            "--cpu",
-            metavar="MAX_USAGE%",
-            type=int,
-            help="maximum CPU usage allowed to consider idle, in %%",
-        )
-        parser.add_argument(
-            "-n",
-            "--network",
-            metavar="PACKETS",
-            type=int,
-            help="maximum number of Rx / Tx packets over a measurement period to consider idle",
-        )
-        parser.add_argument(
-            "-C",
-            "--connection",
-            metavar="SS_ARGS",
-            help="check active network connections using 'ss -HOn ${SS_ARGS}'; no connection shall be returned to consider the machine idle\nExample to detect incoming or outgoing SSH connections over IPv6: \"-6 -t state established 'sport 22 or dport 22'\"",
-        )
+        # a byte is written to the wake-up pipe on signal reception, interrupting the wait of the main loop
+        self.wakeup_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(self.wakeup_fd, False)
+        os.set_blocking(wakeup_write_fd, False)
+        signal.set_wakeup_fd(wakeup_write_fd)
 
         # parse command line arguments
-        self.args = parser.parse_args()
+        self.args = parse_args(sys.argv[1:])
 
         if self.args.x_input or self.args.audio:
             if not self.args.user:
-                parser.error("x_input and audio options requires to specify the user name with -u USER")
+                usage_error("x_input and audio options requires to specify the user name with -u USER")
             self.user = self.args.user
             self.uid = pwd.getpwnam(self.user)[2]
 
+        # long-lived helpers running commands in the user session
+        if self.args.x_input:
+            self.x_idle_command = UserCommand(self.user, {"DISPLAY": ":0"}, "xprintidle")
+
         if self.args.pretend:
             self.args.debug = True
 
@@ -246,24 +558,44 @@ class SleepWhenIdle:
             level=logging.DEBUG if self.args.debug else logging.INFO,
             format=("%(asctime)s " if self.args.pretend else "") + "%(levelname)-8s %(module)-25s %(message)s",
         )
+        # log level does not change at runtime: avoid building debug log arguments at each tick when not needed
+        self.debug = Logger.isEnabledFor(logging.DEBUG)
+
+        # the audio monitor thread logs its state: start it once logging is configured
+        if self.args.audio:
+            self.audio_monitor = AudioMonitor(self.user, self.uid, self.exit_event)
+            self.audio_monitor.start()
 
         # context
-        self.nb_threads = multiprocessing.cpu_count()
-        self.wanted_idle_duration = datetime.timedelta(  # wanted idle time before transition to sleep
-            seconds=self.args.time
-        )
+        self.notifier = SystemdNotifier()
+        # durations are handled as integer nanoseconds, consistent with monotonic_ns()
+        self.wanted_idle_ns = int(self.args.time * 1_000_000_000)  # wanted idle time before transition to sleep
+        self.meas_period_ns = int(self.args.meas_period * 1_000_000_000)  # minimum measurement period
+        self.max_period_ns = max(self.meas_period_ns, self.wanted_idle_ns // 4)  # maximum measurement period
         if self.args.cpu is not None:
             self.cpu_idle_threshold = 1 - self.args.cpu / 100  # threshold to consider CPU as idle
+            self.stat_fd = os.open("/proc/stat", os.O_RDONLY)
+            atexit.register(os.close, self.stat_fd)
+        if self.args.network is not None:
+            self.net_dev_fd = os.open("/proc/net/dev", os.O_RDONLY)
+            atexit.register(os.close, self.net_dev_fd)
+
+        # checks sampling the current state, run at each tick after CPU / network checks, cheapest first
+        self.state_checks = []
+        if self.args.audio:
+            self.state_checks.append(self.check_audio)
+        if self.args.connection:
+            self.state_checks.append(self.check_network_connections)
 
         self.reset()
 
         # validate access to xprintidle if requested
-        if self.args.x_input is not None:
+        if self.args.x_input:
             for _retry in range(10):
                 try:
                     self.get_x_input_idle()
                     break  # X access is successful
-                except subprocess.CalledProcessError:
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
                     # give some time for X to start
                     time.sleep(10)
             else:
@@ -280,35 +612,55 @@ class SleepWhenIdle:
     def reset(self):
         """Reset the dynamic context"""
         Logger.debug("Reset dynamic context")
-        self.prev_cpu_idle_counter = 0  # cpu idle counter at previous tick
-        self.prev_net_stat = NetStat()  # net stats at previous tick
-        self.last_idle = datetime_now()  # last time system was considered idle
+        # cpu idle and total counters at previous tick
+        # seeded with current counters, so that the first tick measures its own period, not the time since boot
+        if self.args.cpu is not None:
+            self.prev_cpu_idle_counter, self.prev_cpu_total_counter = get_cpu_times(self.stat_fd)
+        # net stats at previous tick
+        self.prev_ifname = None  # interface name
+        self.prev_rx_packets = 0  # number of received packets
+        self.prev_tx_packets = 0  # number of transmitted packets
+        self.last_idle = monotonic_ns()  # last time system was considered idle
         self.prev_check = self.last_idle  # time of previous tick
         self.now = self.last_idle  # current time
+        self.period_ns = self.meas_period_ns  # current measurement period
 
         self.delete_any_wakeup()
 
     def run(self):
         """Main task, run forever"""
-        check_period = datetime.timedelta(seconds=self.args.meas_period)
+        self.notifier.notify(b"READY=1")
         while not self.exit_event.is_set():
-            # wait for next measurement period
-            next_check = self.prev_check + check_period
-            self.now = datetime_now()
-            if self.now < next_check:
-                self.exit_event.wait((next_check - self.now).total_seconds())
-                self.now = datetime_now()
+            # notify the watchdog at each tick
+            self.notifier.notify(b"WATCHDOG=1")
+
+            # wait for next measurement period, waking up for the watchdog if needed
+            next_check = self.prev_check + self.period_ns
+            self.now = monotonic_ns()
+            while self.now < next_check and not self.exit_event.is_set():
+                wait_ns = next_check - self.now
+                if self.notifier.watchdog_period_ns is not None:
+                    wait_ns = min(wait_ns, self.notifier.watchdog_period_ns)
+                readable, _, _ = select.select([self.wakeup_fd], [], [], wait_ns / 1e9)
+                if readable:
+                    os.read(self.wakeup_fd, 64)
+                self.now = monotonic_ns()
+                if self.now < next_check:
+                    # still waiting
+                    self.notifier.notify(b"WATCHDOG=1")
 
             # exit if requested
             if self.exit_event.is_set():
                 break
 
             # skipping a check period indicates a sleep cycle
-            if self.now > next_check + check_period:
+            if self.now > next_check + self.period_ns:
                 # reset completely
                 self.reset()
                 continue
 
+            last_idle = self.last_idle
+
             # check CPU usage
             if self.args.cpu is not None:
                 self.check_cpu()
@@ -317,29 +669,42 @@ class SleepWhenIdle:
             if self.args.network is not None:
                 self.check_net()
 
-            # check audio usage
-            if self.args.audio:
-                self.check_audio()
-
-            # check network connections
-            if self.args.connection:
-                self.check_network_connections()
+            # check audio usage, network connections
+            # skip the remaining checks as soon as one has detected activity at this tick
+            for check in self.state_checks:
+                if self.last_idle == self.now:
+                    break
+                check()
 
             # check user input in X server
-            if self.args.x_input is not None and self.now > self.last_idle + self.wanted_idle_duration:
+            # it reports the X idle time, needed once the system has been idle long enough so far,
+            # or when no activity has been detected at this tick, before growing the measurement period
+            if self.args.x_input and (self.is_idle_long_enough() or self.last_idle == last_idle):
                 self.check_x_input()
 
             # enough idle time ?
-            if self.now > self.last_idle + self.wanted_idle_duration:
+            if self.is_idle_long_enough():
                 self.go_to_sleep()
 
+            # adapt measurement period, once all checks of this tick have run:
+            # back to the minimum on any activity, grow it while the system stays idle
+            if self.last_idle != last_idle:
+                self.period_ns = self.meas_period_ns
+            else:
+                self.period_ns = min(2 * self.period_ns, self.max_period_ns)
+
             # go for a new period
             self.prev_check = self.now
 
+        self.notifier.notify(b"STOPPING=1")
         # on normal termination, delete any wakeup previously programmed
         self.delete_any_wakeup()
         Logger.info("Terminated")
 
+    def is_idle_long_enough(self) -> bool:
+        """Check whether the system has been idle long enough to transition to sleep"""
+        return self.now - self.last_idle >= self.wanted_idle_ns
+
     def reset_idle(self, idle_delta=None):
         """Reset idle time to current"""
         if idle_delta is None:
@@ -349,44 +714,34 @@ class SleepWhenIdle:
             last_idle = self.now - idle_delta
             if last_idle > self.last_idle:
                 self.last_idle = last_idle
-                Logger.debug("Updating last_idle as %s", self.last_idle)
+                if self.debug:
+                    Logger.debug("Updating last_idle, idle for %d ms", idle_delta // 1_000_000)
 
     def check_audio(self):
         """Check audio output"""
-        # root has no direct access to the pulseaudio daemon
-        # To detect audio output from the user pulseaudio daemon, use the following command:
-        # XDG_RUNTIME_DIR=/run/user/uid runuser -l user -w XDG_RUNTIME_DIR -c "pacmd list-sink-inputs"
-        # and check for "state: RUNNING" in the output
-        res = subprocess.run(
-            [
-                "runuser",
-                "-l",
-                self.user,
-                "-w",
-                "XDG_RUNTIME_DIR",
-                "-c",
-                "pacmd list-sink-inputs",
-            ],
-            env={"XDG_RUNTIME_DIR": f"/run/user/{self.uid}"},
-            capture_output=True,
-            check=False,  # it may fail if audio is not started yet => consider there is no audio
-            text=True,
-        )
-
-        if res.returncode == 0 and "state: RUNNING" in res.stdout:
+        # audio state is maintained by the audio monitor thread
+        if self.audio_monitor.running:
             Logger.debug("audio is running")
             # audio output is active
             self.reset_idle()
+        elif self.audio_monitor.last_running_ns is not None:
+            # audio output may have stopped since previous tick
+            self.reset_idle(max(self.now - self.audio_monitor.last_running_ns, 0))
 
     def check_network_connections(self):
         """Check network connections"""
         # detect active network connections using ss: ss -HOn ${SS_ARGS}
-        res = subprocess.run(
-            ["ss", "-HOn"] + self.args.connection,
-            capture_output=True,
-            check=True,
-            text=True,
-        )
+        try:
+            res = subprocess.run(
+                ["ss", "-HOn"] + self.args.connection,
+                capture_output=True,
+                check=True,
+                timeout=COMMAND_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            Logger.warning("Timeout when checking network connections; system is not considered as idle")
+            self.reset_idle()
+            return
 
         if res.stdout:
             Logger.debug("active network connections")
@@ -394,35 +749,43 @@ class SleepWhenIdle:
 
     def check_cpu(self):
         """Check CPU usage over a period"""
-        cpu_idle_counter = get_cpu_idle()
-        Logger.debug("cpu_idle_counter: %s", cpu_idle_counter)
-        average_cpu_idle = (
-            (cpu_idle_counter - self.prev_cpu_idle_counter)
-            / self.nb_threads
-            / (self.now - self.prev_check).total_seconds()
-        )
-        Logger.debug("average_cpu_idle: %s", average_cpu_idle)
+        cpu_idle_counter, cpu_total_counter = get_cpu_times(self.stat_fd)
+        if self.debug:
+            Logger.debug("cpu_idle_counter: %s, cpu_total_counter: %s", cpu_idle_counter, cpu_total_counter)
 
-        if average_cpu_idle < self.cpu_idle_threshold:
-            # CPU usage is too high, system is not idle
-            self.reset_idle()
+        if cpu_total_counter > self.prev_cpu_total_counter:
+            average_cpu_idle = (cpu_idle_counter - self.prev_cpu_idle_counter) / (
+                cpu_total_counter - self.prev_cpu_total_counter
+            )
+            if self.debug:
+                Logger.debug("average_cpu_idle: %s", average_cpu_idle)
+
+            if average_cpu_idle < self.cpu_idle_threshold:
+                # CPU usage is too high, system is not idle
+                self.reset_idle()
 
         self.prev_cpu_idle_counter = cpu_idle_counter
+        self.prev_cpu_total_counter = cpu_total_counter
 
     def check_net(self):
         """Check network usage over a period"""
-        net_stat = get_net_stat()
-        Logger.debug("net_stat: %s", net_stat)
+        ifname, rx_packets, tx_packets = get_net_stat(self.net_dev_fd, self.prev_ifname)
+        if self.debug:
+            Logger.debug("net_stat: ifname=%s rx_packets=%d tx_packets=%d", ifname, rx_packets, tx_packets)
 
+        # threshold is given for the minimum measurement period
+        max_packets = self.args.network * self.period_ns // self.meas_period_ns
         if (
-            net_stat.ifname != self.prev_net_stat.ifname
-            or net_stat.rx_packets > self.prev_net_stat.rx_packets + self.args.network
-            or net_stat.tx_packets > self.prev_net_stat.tx_packets + self.args.network
+            ifname != self.prev_ifname
+            or rx_packets > self.prev_rx_packets + max_packets
+            or tx_packets > self.prev_tx_packets + max_packets
         ):
             # network usage is too high, system is not idle
             self.reset_idle()
 
-        self.prev_net_stat = net_stat
+        self.prev_ifname = ifname
+        self.prev_rx_packets = rx_packets
+        self.prev_tx_packets = tx_packets
 
     def get_x_input_idle(self) -> int:
         """Get idle time of user under X"""
@@ -431,70 +794,95 @@ class SleepWhenIdle:
         # DISPLAY=:0 runuser -l user -w DISPLAY -c xprintidle
         # The user need to allow its own user to access the X session with the MIT-MAGIC-COOKIE-1
         # by issuing xhost +si:localuser:my_user_name
-        res = subprocess.run(
-            ["runuser", "-l", self.user, "-w", "DISPLAY", "-c", "xprintidle"],
-            env={"DISPLAY": ":0"},
-            capture_output=True,
-            check=True,
-            text=True,
-        )
-        x_idle_ms = int(res.stdout)
-        Logger.debug("x_idle: %d ms", x_idle_ms)
+        res = self.x_idle_command.run()
+        res.check_returncode()
+        x_idle_ms = int(res.stdout.strip())
+        if self.debug:
+            Logger.debug("x_idle: %d ms", x_idle_ms)
         return x_idle_ms
 
     def check_x_input(self):
         """Check inputs from user in Xserver"""
-        x_idle_ms = self.get_x_input_idle()
-        x_idle = datetime.timedelta(milliseconds=x_idle_ms)
+        try:
+            x_idle_ms = self.get_x_input_idle()
+        except subprocess.TimeoutExpired:
+            Logger.warning("Timeout when getting X idle time; system is not considered as idle")
+            self.reset_idle()
+            return
+        x_idle = x_idle_ms * 1_000_000
 
-        if x_idle < self.wanted_idle_duration:
+        if x_idle < self.wanted_idle_ns:
             # update idle based on x_idle
             self.reset_idle(x_idle)
 
     def go_to_sleep(self):
         """Initiate transition to sleep"""
         Logger.info("System is idle, going to sleep")
-        if self.args.wake_up is not None:
-            self.program_wakeup()
-        # reset last_idle to prevent multiple sleep requests in a row
+        # reset last_idle to prevent multiple sleep requests in a row; a failed request is retried after TIME
         self.last_idle = self.now
+        if self.args.wake_up is not None and not self.program_wakeup():
+            Logger.warning("Wake-up could not be programmed; not going to sleep")
+            return
         if not self.args.pretend:
             # sleep; note: the request is asynchronous
-            subprocess.run(["systemctl", self.args.state], check=True)
+            try:
+                subprocess.run(["systemctl", self.args.state], check=True, timeout=COMMAND_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                Logger.warning("Timeout when requesting sleep")
 
     def delete_any_wakeup(self):
         """Delete any wake-up previously programmed"""
         if self.args.wake_up is not None:
             Logger.info("Resetting any programmed wake-up")
             if not self.args.pretend:
-                res = subprocess.run(
-                    ["rtcwake", "-m", "disable"],
-                    capture_output=True,
-                    check=True,
-                    text=True,
-                )
-                Logger.debug("Command 'rtcwake -m disable' stdout: %s", res.stdout)
+                self.run_command(["rtcwake", "-m", "disable"])
+
+    def program_wakeup(self) -> bool:
+        """Program wake-up
 
-    def program_wakeup(self):
-        """Program wake-up"""
+        Returns:
+            whether the wake-up has been programmed
+        """
         # determine wake-up time: today ?
-        wake_up = datetime.datetime.combine(self.now.date(), self.args.wake_up).astimezone()
-        if wake_up < self.now:
+        now = time.time()
+        local_now = time.localtime(now)
+        # mktime handles DST transitions (tm_isdst=-1) and normalizes the day of the month
+        wake_up = time.mktime((local_now.tm_year, local_now.tm_mon, local_now.tm_mday, *self.args.wake_up, 0, 0, -1))
+        if wake_up < now:
             # wake_up is tomorrow
-            wake_up = datetime.datetime.combine(
-                self.now.date() + datetime.timedelta(days=1), self.args.wake_up
-            ).astimezone()
-        Logger.info("Programming wake-up for %s", wake_up)
-        if not self.args.pretend:
-            timestamp = str(int(wake_up.timestamp()))
-            res = subprocess.run(
-                ["rtcwake", "-m", "no", "-t", timestamp],
-                capture_output=True,
-                check=True,
-                text=True,
+            wake_up = time.mktime(
+                (local_now.tm_year, local_now.tm_mon, local_now.tm_mday + 1, *self.args.wake_up, 0, 0, -1)
             )
-            Logger.debug("Command 'rtcwake -m no -t %s' stdout: %s", timestamp, res.stdout)
+        Logger.info("Programming wake-up for %s", time.strftime("%Y-%m-%d %H:%M:%S%z", time.localtime(wake_up)))
+        if self.args.pretend:
+            return True
+        return self.run_command(["rtcwake", "-m", "no", "-t", str(int(wake_up))])
+
+    def run_command(self, cmd: typing.List[str]) -> bool:
+        """Run a command, its output being only used for debug log
+
+        Returns:
+            False if the command has timed out
+        """
+        try:
+            if self.debug:
+                res = subprocess.run(cmd, capture_output=True, check=True, text=True, timeout=COMMAND_TIMEOUT)
+                Logger.debug("Command '%s' stdout: %s", shlex.join(cmd), res.stdout)
+            else:
+                subprocess.run(
+                    cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=COMMAND_TIMEOUT
+                )
+        except subprocess.TimeoutExpired:
+            Logger.warning("Timeout when running command '%s'", shlex.join(cmd))
+            return False
+        return True
 
 
-if __name__ == "__main__":
+def main() -> int:
+    """Run the daemon until termination"""
     SleepWhenIdle().run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())